@@ -0,0 +1,9 @@
+# Production server settings, picked up automatically by `gunicorn main:app`
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# argon2 releases the GIL while hashing, so threads let logins/registrations overlap within a worker.
+# Each hash holds 64 MiB while it runs, so peak memory per worker is about threads * 64 MiB
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
@@ -1,31 +1,53 @@
-from flask import Flask, render_template, redirect, url_for, flash, abort
+from flask import Flask, render_template, redirect, url_for, flash, abort, request
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor, CKEditorField
-from datetime import date
+from datetime import date, datetime
 from werkzeug.security import generate_password_hash, check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
-from sqlalchemy.exc import NoResultFound
-from sqlalchemy import ForeignKey
+from sqlalchemy.orm import relationship, selectinload, defer, raiseload, make_transient_to_detached
+from sqlalchemy import ForeignKey, event, inspect
+from sqlalchemy.exc import IntegrityError
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm
 from flask_gravatar import Gravatar
+from flask_caching import Cache
+import bleach
 from functools import wraps
+import hashlib
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('FLASK_KEY')
+# CSRF tokens stay valid for the whole session instead of being regenerated every hour
+app.config['WTF_CSRF_TIME_LIMIT'] = None
 ckeditor = CKEditor(app)
 Bootstrap5(app)
 
+##PAGE CACHE for anonymous visitors, cleared whenever posts or comments change.
+# Kept on disk by default so all gunicorn workers share it and cache.clear() reaches every one of them
+# (an in-memory SimpleCache would only be cleared in the worker that handled the write). CACHE_TYPE can
+# point it elsewhere, e.g. RedisCache
+app.config['CACHE_TYPE'] = os.getenv('CACHE_TYPE', 'FileSystemCache')
+app.config['CACHE_DIR'] = os.getenv('CACHE_DIR', os.path.join(app.instance_path, 'page-cache'))
+app.config['CACHE_DEFAULT_TIMEOUT'] = 300
+cache = Cache(app)
+
+def skip_cache():
+    # logged in users get admin links and a comment form, and POSTs must always reach the view
+    return current_user.is_authenticated or request.method != 'GET'
+
 ##SET UP LOGIN MANAGER
 login_manager = LoginManager()
 login_manager.init_app(app)
 
-##GRAVATAR for the commenter images
+##GRAVATAR for the commenter images, only used for users without an email_md5 (see gravatar_url)
 gravatar = Gravatar(app,
                     size=100,
                     rating='g',
@@ -35,13 +57,102 @@ gravatar = Gravatar(app,
                     use_ssl=False,
                     base_url=None)
 
+##HTML SANITIZER for CKEditor output (post bodies and comments), which the templates render with |safe.
+# Run when content is saved rather than on every render. bleach's Cleaner isn't thread-safe (its html parser
+# keeps state), so each worker thread builds its own once and reuses it
+HTML_CLEANER_OPTIONS = dict(
+    tags={'p', 'br', 'hr', 'strong', 'b', 'em', 'i', 'u', 's', 'sub', 'sup', 'a', 'img', 'span', 'blockquote',
+          'pre', 'code', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+          'table', 'thead', 'tbody', 'tr', 'th', 'td', 'caption', 'figure', 'figcaption'},
+    attributes={'a': ['href', 'title', 'target', 'rel'], 'img': ['src', 'alt', 'width', 'height'],
+                'th': ['colspan', 'rowspan'], 'td': ['colspan', 'rowspan']},
+    protocols={'http', 'https', 'mailto'},
+    strip=True
+)
+html_cleaners = threading.local()
+
+def clean_html(html):
+    cleaner = getattr(html_cleaners, 'cleaner', None)
+    if cleaner is None:
+        cleaner = html_cleaners.cleaner = bleach.sanitizer.Cleaner(**HTML_CLEANER_OPTIONS)
+    return cleaner.clean(html)
+
+##PASSWORD HASHING with argon2id. Older accounts still have werkzeug pbkdf2 hashes, those get rehashed on login
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
+
+# Hashes checked against when the login email is unknown, so that branch costs the same as a real check
+DUMMY_PW_HASH = password_hasher.hash("x" * 16)
+LEGACY_DUMMY_PW_HASH = generate_password_hash("x" * 16, method='pbkdf2:sha256', salt_length=8)
+# True while any account still has a pbkdf2 hash. Only ever goes from True to False (new hashes are argon2):
+# checked at startup, right after this worker rehashes a legacy password, and at most every
+# LEGACY_HASH_RECHECK seconds on login so the other workers notice too
+LEGACY_HASH_RECHECK = 60
+legacy_hashes_remain = True
+legacy_hashes_checked_at = 0.0
+
+def update_legacy_hashes_remain(force=False):
+    global legacy_hashes_remain, legacy_hashes_checked_at
+    if not legacy_hashes_remain:
+        return
+    if force or time.monotonic() - legacy_hashes_checked_at > LEGACY_HASH_RECHECK:
+        legacy_hashes_checked_at = time.monotonic()
+        legacy_hashes_remain = db.session.scalar(
+            db.select(User.id).where(User.password.like('pbkdf2:%')).limit(1)
+        ) is not None
+
+def argon2_matches(pw_hash, password):
+    try:
+        return password_hasher.verify(pw_hash, password)
+    except VerifyMismatchError:
+        return False
+
+def check_password(pw_hash, password):
+    is_legacy = pw_hash.startswith('pbkdf2:')
+    matches = check_password_hash(pw_hash, password) if is_legacy else argon2_matches(pw_hash, password)
+    # while pbkdf2 accounts exist, every check pays for both algorithms, so the time taken
+    # doesn't tell an unknown email apart from a dormant account that still has an old hash
+    if legacy_hashes_remain:
+        if is_legacy:
+            argon2_matches(DUMMY_PW_HASH, password)
+        else:
+            check_password_hash(LEGACY_DUMMY_PW_HASH, password)
+    return matches
+
+##USER CACHE, so load_user doesn't query the db on every request. Per worker process, entries live 30 s
+USER_CACHE_TTL = 30
+USER_CACHE_SIZE = 1024
+USER_CACHE_COLUMNS = ('id', 'email', 'password', 'name', 'email_md5')
+# user id -> (expiry time, column values). Plain values, never a User: that belongs to the session that loaded it
+user_cache = {}
+user_cache_lock = threading.Lock()
+
+def forget_user(user_id):
+    with user_cache_lock:
+        user_cache.pop(user_id, None)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    user_id = int(user_id)
+    with user_cache_lock:
+        entry = user_cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        # rebuild a detached User from the cached values, load=False attaches it to this session without a SELECT
+        user = User(**entry[1])
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    user = db.session.get(User, user_id)
+    if user is not None:
+        columns = {col: getattr(user, col) for col in USER_CACHE_COLUMNS}
+        with user_cache_lock:
+            if len(user_cache) >= USER_CACHE_SIZE:
+                user_cache.pop(next(iter(user_cache)))
+            user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, columns)
+    return user
 
 ##CONNECT TO DB
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_URL', 'sqlite:///blog.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"pool_pre_ping": True}
 db = SQLAlchemy(app)
 
 
@@ -50,9 +161,11 @@ db = SQLAlchemy(app)
 class User(UserMixin, db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String, nullable=False)
+    email = db.Column(db.String(254), nullable=False, unique=True, index=True)
     password = db.Column(db.String, nullable=False)
     name = db.Column(db.String, nullable=False)
+    # md5 of the email for gravatar, worked out once at registration. NULL for users registered before it existed
+    email_md5 = db.Column(db.String(32))
     posts = relationship('BlogPost', back_populates='author')  # this is important
     comments = relationship('Comment', back_populates='commenter')
     # back_populates is better than backref.
@@ -69,10 +182,11 @@ class BlogPost(db.Model):
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))  # dit is de joint
 # relationship is like this: ('Class name' with which to connect, and then the column in that db Model to communicate content
     author = relationship('User', back_populates='posts')  # this is important
-    comments = relationship('Comment', back_populates='post')
+    # the db deletes a post's comments itself (see Comment.post_id), so the ORM needn't load them first
+    comments = relationship('Comment', back_populates='post', cascade='all, delete-orphan', passive_deletes=True)
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True, default=date.today)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
 
@@ -81,12 +195,43 @@ class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     commenter_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     commenter = relationship('User', back_populates='comments')
-    post_id = db.Column(db.Integer, db.ForeignKey('blog_posts.id'))
+    post_id = db.Column(db.Integer, db.ForeignKey('blog_posts.id', ondelete='CASCADE'))
     post = relationship('BlogPost', back_populates='comments')
     text = db.Column(db.String, nullable=False)
 
+def sqlite_pragmas(dbapi_conn, _):
+    # WAL + synchronous=NORMAL avoids an fsync per commit, the rest gives reads a bigger cache
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA cache_size=-65536")  # 64 MiB
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    # SQLite ignores foreign keys (and so ON DELETE CASCADE) unless told otherwise
+    cur.execute("PRAGMA foreign_keys=ON")
+    cur.close()
+
 with app.app_context():
+    # register before create_all() so every pooled connection gets the pragmas
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', sqlite_pragmas)
     db.create_all()
+    # create_all() doesn't alter existing tables, so add the email index to databases made before it existed
+    db.session.execute(db.text("CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email ON users (email)"))
+    if 'email_md5' not in [col['name'] for col in inspect(db.engine).get_columns('users')]:
+        db.session.execute(db.text("ALTER TABLE users ADD COLUMN email_md5 VARCHAR(32)"))
+    # post dates used to be stored as "May 17, 2023" strings, convert them to real dates
+    if db.engine.dialect.name == 'sqlite':
+        legacy_dates = db.session.execute(db.text("SELECT id, date FROM blog_posts WHERE date NOT LIKE '____-__-__'"))
+        for post_id, post_date in legacy_dates.all():
+            db.session.execute(db.text("UPDATE blog_posts SET date = :date WHERE id = :id"),
+                               {"date": datetime.strptime(post_date, "%B %d, %Y").date().isoformat(), "id": post_id})
+    elif any(col['name'] == 'date' and isinstance(col['type'], db.String)
+             for col in inspect(db.engine).get_columns('blog_posts')):
+        db.session.execute(db.text("ALTER TABLE blog_posts ALTER COLUMN date TYPE DATE USING to_date(date, 'FMMonth DD, YYYY')"))
+    db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_blog_posts_date ON blog_posts (date)"))
+    db.session.commit()
+    update_legacy_hashes_remain(force=True)
 
 
 def admin_only(func):
@@ -103,31 +248,84 @@ def admin_only(func):
                 return func(*args, **kwargs)
     return wrapper
 
+@app.template_global()
+def gravatar_url(user, size=100):
+    if user.email_md5 is None:
+        return gravatar(user.email, size=size)
+    return f"https://www.gravatar.com/avatar/{user.email_md5}?s={size}&d=retro&r=g"
+
+@app.template_filter('post_date')
+def format_post_date(value):
+    return value.strftime("%B %d, %Y")
+
+POSTS_PER_PAGE = 10
+
+def get_post_or_404(post_id):
+    return db.one_or_404(db.select(BlogPost).where(BlogPost.id == post_id))
+
+# show_post keeps the post itself (not its comments) in the shared cache for 15 s, so the redirect after a comment
+# doesn't fetch it again. Stored as a plain dict, not a session-bound ORM object. The cache.clear() calls on
+# post changes drop it in every worker, and a missing post (None) isn't cached
+POST_CACHE_TTL = 15
+
+@cache.memoize(timeout=POST_CACHE_TTL)
+def get_post_row(post_id):
+    row = db.session.execute(
+        db.select(BlogPost.id, BlogPost.title, BlogPost.subtitle, BlogPost.date, BlogPost.body, BlogPost.img_url,
+                  User.name.label('author_name'))
+        .join(User, BlogPost.author_id == User.id)
+        .where(BlogPost.id == post_id)
+    ).one_or_none()
+    return None if row is None else row._asdict()
+
+def get_comments(post_id):
+    # raiseload makes any lazy load the template adds an error instead of an N+1
+    return db.session.execute(
+        db.select(Comment).where(Comment.post_id == post_id).order_by(Comment.id)
+        .options(selectinload(Comment.commenter), raiseload('*', sql_only=True))
+    ).scalars().all()
+
 @app.route('/')
+@cache.cached(unless=skip_cache, query_string=True)
 def get_all_posts():
-    posts = BlogPost.query.all()
-    return render_template("index.html", all_posts=posts)
+    page = request.args.get('page', 1, type=int)
+    # load all authors in one extra query instead of one per post, and skip the bodies the index doesn't show.
+    # raiseload turns the body, or any other relationship the template touches, into an error rather than a query per post
+    posts = db.paginate(
+        db.select(BlogPost)
+        .order_by(BlogPost.date.desc(), BlogPost.id.desc())
+        .options(defer(BlogPost.body, raiseload=True), selectinload(BlogPost.author),
+                 raiseload('*', sql_only=True)),
+        page=page, per_page=POSTS_PER_PAGE, error_out=False
+    )
+    return render_template("index.html", all_posts=posts.items, pagination=posts)
 
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     register_form = RegisterForm()
     if register_form.validate_on_submit():
-        check_user = db.session.execute(db.select(User).filter_by(email=register_form.email.data)).first()
-        if not check_user:
-            hashed_pw = generate_password_hash(register_form.password.data, method='pbkdf2:sha256', salt_length=8)
-            user = User(
-                email=register_form.email.data,
-                password=hashed_pw,
-                name=register_form.name.data
-            )
+        # cheap index lookup first, so re-posting a known email doesn't cost us a password hash
+        if db.session.scalar(db.select(User.id).filter_by(email=register_form.email.data).limit(1)) is not None:
+            flash('We already have this address on file, please log in.')
+            return redirect(url_for('login'))
+        user = User(
+            email=register_form.email.data,
+            password=password_hasher.hash(register_form.password.data),
+            name=register_form.name.data,
+            email_md5=hashlib.md5(register_form.email.data.strip().lower().encode()).hexdigest()
+        )
+        try:
             db.session.add(user)
             db.session.commit()
-            login_user(user)
-            return redirect(url_for('get_all_posts'))
-        else:
+        except IntegrityError:
+            # the same email was registered between the check above and this insert
+            db.session.rollback()
             flash('We already have this address on file, please log in.')
             return redirect(url_for('login'))
+        forget_user(user.id)
+        login_user(user)
+        return redirect(url_for('get_all_posts'))
     return render_template("register.html", form=register_form)
 
 
@@ -135,18 +333,24 @@ def register():
 def login():
     login_form = LoginForm()
     if login_form.validate_on_submit():
-        try:
-            user = db.session.execute(db.select(User).filter_by(email=login_form.email.data)).scalar_one()
-        except NoResultFound:
-            flash('Unknown user')
-            return redirect(url_for('login'))
-        else:
-            if check_password_hash(user.password, login_form.password.data):
-                login_user(user)
-                return redirect(url_for('get_all_posts'))
-            else:
-                flash('Invalid password')
-                return redirect(url_for('login'))
+        update_legacy_hashes_remain()
+        user = db.session.execute(db.select(User).filter_by(email=login_form.email.data)).scalar_one_or_none()
+        if user is None:
+            # do the same hashing work as for a known user, so response time doesn't reveal registered emails
+            check_password(DUMMY_PW_HASH, login_form.password.data)
+        elif check_password(user.password, login_form.password.data):
+            was_legacy = user.password.startswith('pbkdf2:')
+            if was_legacy or password_hasher.check_needs_rehash(user.password):
+                user.password = password_hasher.hash(login_form.password.data)
+                db.session.commit()
+                forget_user(user.id)
+                if was_legacy:
+                    update_legacy_hashes_remain(force=True)
+            login_user(user)
+            return redirect(url_for('get_all_posts'))
+        # same message for both failures so the flash text doesn't leak which one happened
+        flash('Invalid email or password')
+        return redirect(url_for('login'))
     return render_template("login.html", form=login_form)
 
 
@@ -158,31 +362,42 @@ def logout():
 
 
 @app.route("/post/<int:post_id>", methods=['GET', 'POST'])
+@cache.cached(unless=skip_cache)
 def show_post(post_id):
-    requested_post = BlogPost.query.get(post_id)
-    form = CommentForm()
-    if form.validate_on_submit():
-        if not current_user.is_authenticated:
+    requested_post = get_post_row(post_id)
+    if requested_post is None:
+        return abort(404)
+    # most readers are anonymous and can't comment anyway, so don't build the form for them
+    if not current_user.is_authenticated:
+        if request.method == 'POST':
             flash("You need to log in or register in order to leave comments.")
             return redirect(url_for('login'))
-        else:
-            comment = Comment(
-                text=form.comment.data,
-                commenter=current_user,
-                post=requested_post
-            )
-            db.session.add(comment)
-            db.session.commit()
-            return redirect(url_for('show_post', post_id=post_id))
-    return render_template("post.html", post=requested_post, form=form)
+        return render_template("post.html", post=requested_post, comments=get_comments(post_id), form=None)
+    form = CommentForm()
+    if form.validate_on_submit():
+        comment = Comment(
+            text=clean_html(form.comment.data),
+            commenter=current_user,
+            post_id=post_id
+        )
+        db.session.add(comment)
+        # flush to get the new id now: after commit() the object is expired and reading it would SELECT again
+        db.session.flush()
+        comment_id = comment.id
+        db.session.commit()
+        cache.clear()
+        return redirect(url_for('show_post', post_id=post_id, _anchor=f'c{comment_id}'))
+    return render_template("post.html", post=requested_post, comments=get_comments(post_id), form=form)
 
 
 @app.route("/about")
+@cache.cached(unless=skip_cache)
 def about():
     return render_template("about.html")
 
 
 @app.route("/contact")
+@cache.cached(unless=skip_cache)
 def contact():
     return render_template("contact.html")
 
@@ -195,13 +410,13 @@ def add_new_post():
         new_post = BlogPost(
             title=form.title.data,
             subtitle=form.subtitle.data,
-            body=form.body.data,
+            body=clean_html(form.body.data),
             img_url=form.img_url.data,
-            author=current_user,
-            date=date.today().strftime("%B %d, %Y")
+            author=current_user
         )
         db.session.add(new_post)
         db.session.commit()
+        cache.clear()
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form)
 
@@ -209,7 +424,7 @@ def add_new_post():
 @app.route("/edit-post/<int:post_id>", methods=['GET', 'POST'])
 @admin_only
 def edit_post(post_id):
-    post = BlogPost.query.get(post_id)
+    post = get_post_or_404(post_id)
     edit_form = CreatePostForm(
         title=post.title,
         subtitle=post.subtitle,
@@ -220,8 +435,9 @@ def edit_post(post_id):
         post.title = edit_form.title.data
         post.subtitle = edit_form.subtitle.data
         post.img_url = edit_form.img_url.data
-        post.body = edit_form.body.data
+        post.body = clean_html(edit_form.body.data)
         db.session.commit()
+        cache.clear()
         return redirect(url_for("show_post", post_id=post.id))
 
     return render_template("make-post.html", form=edit_form)
@@ -230,11 +446,18 @@ def edit_post(post_id):
 @app.route("/delete/<int:post_id>")
 @admin_only
 def delete_post(post_id):
-    post_to_delete = BlogPost.query.get(post_id)
-    db.session.delete(post_to_delete)
+    # delete straight in the db, no need to load the post (or its comments) first.
+    # New databases cascade to the comments themselves, tables created before ON DELETE CASCADE need this
+    db.session.execute(db.delete(Comment).where(Comment.post_id == post_id))
+    result = db.session.execute(db.delete(BlogPost).where(BlogPost.id == post_id))
+    if result.rowcount == 0:
+        db.session.rollback()
+        return abort(404)
     db.session.commit()
+    cache.clear()
     return redirect(url_for('get_all_posts'))
 
 
+# Dev server only. In production run `gunicorn main:app` (settings in gunicorn.conf.py)
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=8000, debug=True)
+    app.run(host='0.0.0.0', port=8000, debug=os.getenv('FLASK_ENV') == 'dev')
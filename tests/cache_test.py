@@ -0,0 +1,73 @@
+"""Anonymous readers must see post changes as soon as they're saved, with both the page and post row caches on."""
+import tempfile
+
+import pytest
+
+from main import app, db, cache, BlogPost
+
+
+@pytest.fixture(scope='module', autouse=True)
+def shared_cache():
+    # the other test modules run with NullCache, switch to a real one for these
+    cache.init_app(app, config={'CACHE_TYPE': 'FileSystemCache', 'CACHE_DIR': tempfile.mkdtemp()})
+    yield
+    cache.init_app(app, config={'CACHE_TYPE': 'NullCache'})
+
+
+@pytest.fixture
+def post_id():
+    with app.app_context():
+        post = BlogPost(title='Original title', subtitle='Subtitle', body='<p>Body</p>',
+                        img_url='https://example.com/img.jpg', author_id=1)
+        db.session.add(post)
+        db.session.commit()
+        return post.id
+
+
+@pytest.fixture
+def admin():
+    client = app.test_client()
+    client.post('/login', data={'email': 'admin@example.com', 'password': 'secret'})
+    return client
+
+
+def test_edit_reaches_anonymous_readers(post_id, admin):
+    reader = app.test_client()
+    assert b'Original title' in reader.get(f'/post/{post_id}').data
+    response = admin.post(f'/edit-post/{post_id}', data={
+        'title': 'Edited title', 'subtitle': 'Subtitle', 'img_url': 'https://example.com/img.jpg', 'body': '<p>Body</p>'
+    })
+    assert response.status_code == 302
+    page = reader.get(f'/post/{post_id}').data
+    assert b'Edited title' in page and b'Original title' not in page
+
+
+def test_edit_from_another_worker(post_id):
+    # another worker saves the change and clears the shared cache; nothing in this process may still hold the old post
+    reader = app.test_client()
+    assert b'Original title' in reader.get(f'/post/{post_id}').data
+    with app.app_context():
+        db.session.get(BlogPost, post_id).title = 'Edited elsewhere'
+        db.session.commit()
+        cache.clear()
+    page = reader.get(f'/post/{post_id}').data
+    assert b'Edited elsewhere' in page and b'Original title' not in page
+
+
+def test_delete_reaches_anonymous_readers(post_id, admin):
+    reader = app.test_client()
+    assert reader.get(f'/post/{post_id}').status_code == 200
+    assert admin.get(f'/delete/{post_id}').status_code == 302
+    assert reader.get(f'/post/{post_id}').status_code == 404
+
+
+def test_new_post_is_not_cached_as_missing():
+    reader = app.test_client()
+    with app.app_context():
+        next_id = (db.session.scalar(db.select(db.func.max(BlogPost.id))) or 0) + 1
+    assert reader.get(f'/post/{next_id}').status_code == 404
+    with app.app_context():
+        db.session.add(BlogPost(id=next_id, title='Brand new', subtitle='Subtitle', body='<p>Body</p>',
+                                img_url='https://example.com/img.jpg', author_id=1))
+        db.session.commit()
+    assert b'Brand new' in reader.get(f'/post/{next_id}').data
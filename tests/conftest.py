@@ -0,0 +1,22 @@
+import os
+import tempfile
+
+# main.py configures the app at import time, so point it at a throwaway db before any test module imports it.
+# NullCache keeps Flask-Caching from answering requests without running the view; tests that need a real
+# cache switch it on themselves
+os.environ['DB_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ['FLASK_KEY'] = 'test'
+os.environ['CACHE_TYPE'] = 'NullCache'
+
+import pytest
+
+from main import app, db, User, password_hasher
+
+
+@pytest.fixture(scope='session', autouse=True)
+def admin_user():
+    # admin_only views only let user 1 in, so create it before any test module adds its own users
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        db.session.add(User(email='admin@example.com', name='Admin', password=password_hasher.hash('secret')))
+        db.session.commit()
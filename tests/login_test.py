@@ -0,0 +1,22 @@
+"""Legacy pbkdf2 hashes: upgraded on login, and the extra timing-equalising work stops once none are left."""
+from werkzeug.security import generate_password_hash
+
+import main
+from main import app, db, User
+
+
+def test_last_legacy_hash_clears_flag(monkeypatch):
+    # as if the app had started with this account already in the db
+    monkeypatch.setattr(main, 'legacy_hashes_remain', True)
+    with app.app_context():
+        db.session.add(User(email='legacy@example.com', name='Legacy',
+                            password=generate_password_hash('secret', method='pbkdf2:sha256', salt_length=8)))
+        db.session.commit()
+        main.update_legacy_hashes_remain(force=True)
+    assert main.legacy_hashes_remain
+
+    response = app.test_client().post('/login', data={'email': 'legacy@example.com', 'password': 'secret'})
+    assert response.status_code == 302
+    with app.app_context():
+        assert db.session.scalar(db.select(User.password).filter_by(email='legacy@example.com')).startswith('$argon2id$')
+    assert not main.legacy_hashes_remain
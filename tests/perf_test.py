@@ -0,0 +1,95 @@
+"""SQL query budgets for the main views.
+
+Each test seeds several posts, authors and comments, then counts the statements a request runs. A view that
+lazy-loads per row (a dropped selectinload, a template touching a new relationship) goes over its budget.
+"""
+import contextlib
+
+import pytest
+from sqlalchemy import event
+
+from main import app, db, User, BlogPost, Comment, password_hasher, user_cache
+
+
+@contextlib.contextmanager
+def count_queries(engine):
+    n = [0]
+
+    def _count(*args, **kwargs):
+        n[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', _count)
+    try:
+        yield n
+    finally:
+        event.remove(engine, 'before_cursor_execute', _count)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def post_id():
+    with app.app_context():
+        users = [User(email=f'user{i}@example.com', name=f'User {i}', password=password_hasher.hash('secret'))
+                 for i in range(3)]
+        for i in range(5):
+            post = BlogPost(title=f'Post {i}', subtitle='Subtitle', body='<p>Body</p>',
+                            img_url='https://example.com/img.jpg', author=users[i % 3])
+            for j in range(4):
+                db.session.add(Comment(text=f'Comment {j}', commenter=users[j % 3], post=post))
+        db.session.commit()
+        return post.id
+
+
+@pytest.fixture
+def client():
+    user_cache.clear()
+    return app.test_client()
+
+
+@pytest.fixture
+def engine():
+    with app.app_context():
+        return db.engine
+
+
+def log_in(client):
+    client.post('/login', data={'email': 'user1@example.com', 'password': 'secret'})
+
+
+def test_index(client, engine):
+    # page count, the page of posts, their authors
+    with count_queries(engine) as n:
+        assert client.get('/').status_code == 200
+    assert n[0] <= 3
+
+
+def test_index_logged_in(client, engine):
+    log_in(client)
+    # as above, plus load_user
+    with count_queries(engine) as n:
+        assert client.get('/').status_code == 200
+    assert n[0] <= 4
+
+
+def test_show_post(client, engine, post_id):
+    # the post with its author, its comments, their commenters
+    with count_queries(engine) as n:
+        assert client.get(f'/post/{post_id}').status_code == 200
+    assert n[0] <= 3
+
+
+def test_show_post_logged_in(client, engine, post_id):
+    log_in(client)
+    with count_queries(engine) as n:
+        assert client.get(f'/post/{post_id}').status_code == 200
+    assert n[0] <= 4
+
+
+def test_login(client, engine):
+    with count_queries(engine) as n:
+        assert client.get('/login').status_code == 200
+    assert n[0] == 0
+    # the user lookup by email and nothing else
+    with count_queries(engine) as n:
+        response = client.post('/login', data={'email': 'user0@example.com', 'password': 'secret'})
+    assert response.status_code == 302
+    assert n[0] <= 1